@@ -4,24 +4,56 @@ from pymc3.distributions import Continuous
 from theano import scan, function, printing
 import theano.tensor as T
 import theano
+from theano.ifelse import ifelse
 from pymc3 import fit, sample_approx
 from pymc3 import traceplot, find_MAP
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import warnings
 import re
 import pandas as pd
 import seaborn as sns
 from timeit import default_timer as timer
 from collections import OrderedDict, Counter
-from itertools import product
+from itertools import chain
 from DMpy.utils import *
 from DMpy.logp import *
+from DMpy.learning import rescorla_wagner
 from sklearn.metrics import r2_score
 import copy
 import inspect
+import multiprocessing
 
 theano.config.compute_test_value = "off"
 
+# matches the parameter name in names of transformed variables, e.g. alpha in alpha_interval__
+_TRANSFORMED_NAME_RE = re.compile('.+(?=_.+__)')
+
+# number of trials up to which the delta rule is evaluated in closed form rather than with scan during fitting, the closed
+# form builds (trials x trials x subjects) arrays so it's only worthwhile for short sequences
+_CLOSED_FORM_MAX_TRIALS = 100
+
+# number of built PyMC3 models kept by each DMModel instance, see DMModel.fit
+_MODEL_CACHE_SIZE = 4
+
+# compiled simulation functions, see DMModel._define_simulate_function
+_simulate_function_cache = {}
+
+# simulation function used by worker processes when simulating in parallel, set in each worker by the pool's initializer
+# so it's available whichever start method (fork, spawn, forkserver) multiprocessing uses
+_parallel_simulate_function = None
+
+
+def _init_simulate_worker(simulate_function):
+
+    global _parallel_simulate_function
+    _parallel_simulate_function = simulate_function
+
+
+def _simulate_chunk(inputs):
+
+    return _parallel_simulate_function(*inputs)
+
 sns.set_style("white")
 sns.set_palette("Set1")
 
@@ -107,30 +139,73 @@ def _initialise_parameters(learning_parameters, observation_parameters, n_subjec
     return dynamic_parameters, static_parameters, observation_parameters
 
 
+def _parameter_spec(p):
+
+    # everything about a parameter that affects the PyMC3 model built from it
+    if p is None:
+        return None
+    return (p.name, p.distribution, p.lower_bound, p.upper_bound, p.mean, p.variance, p.dynamic, p.fixed,
+            p.transform_method, sorted(p._Parameter__pymc_kwargs.items()))
+
+
 def _add_noise(timeseries, mean, sd, lower_bound=0, upper_bound=1):
 
-    noisy_timeseries = timeseries + np.random.normal(mean, sd, timeseries.shape)
+    # add the timeseries to the noise array in place rather than allocating another array for the sum
+    if sd > 0:
+        noisy_timeseries = np.random.normal(mean, sd, timeseries.shape)
+        noisy_timeseries += np.asarray(timeseries)
 
-    noisy_timeseries[noisy_timeseries > upper_bound] = upper_bound
-    noisy_timeseries[noisy_timeseries < lower_bound] = lower_bound
+    # no random draws are needed if the noise is only a shift in the mean
+    else:
+        noisy_timeseries = np.asarray(timeseries, dtype=np.float64) + mean
+
+    np.clip(noisy_timeseries, lower_bound, upper_bound, out=noisy_timeseries)
 
     return noisy_timeseries
 
 
+def _linear_update_value(outcomes, v0, alpha):
+
+    """
+    Closed form of the delta rule learning model (v = v + alpha * (o - v)), used in place of scan when fitting
+    rescorla_wagner to at most _CLOSED_FORM_MAX_TRIALS trials
+
+    Args:
+        outcomes: Outcome data, shape (n_trials, n_subjects)
+        v0: Starting values, shape (n_subjects, )
+        alpha: Learning rates, shape (n_subjects, )
+
+    Returns:
+        value: Value on each trial before seeing that trial's outcome, shape (n_trials, n_subjects)
+    """
+
+    decay = 1 - alpha
+    trials = T.arange(outcomes.shape[0])
+
+    # weight of outcome k in the value on trial t is alpha * decay ** (t - k - 1), outcomes from trial t onwards are
+    # masked out
+    lag = trials.dimshuffle(0, 'x') - trials.dimshuffle('x', 0) - 1
+    mask = T.ge(lag, 0).dimshuffle(0, 1, 'x')
+    weights = alpha * decay ** T.maximum(lag, 0).dimshuffle(0, 1, 'x') * mask
+
+    value = decay ** trials.dimshuffle(0, 'x') * v0 + (weights * outcomes.dimshuffle('x', 0, 1)).sum(axis=1)
+
+    return value
+
+
 class _PyMCModel(Continuous):
 
     """
     Instance of PyMC3 model used to fit models. Used internally by DMModel class - do not use directly.
     """
 
-    def __init__(self, learning_models, learning_parameters, observation_model, observation_parameters, responses, hierarchical,
+    def __init__(self, learning_model, learning_parameters, observation_model, observation_parameters, responses, hierarchical,
                  n_subjects, time, n_runs, mle=False, outcomes=None, model_inputs=None, logp_function=None, vars=None,
                  logp_args=None, *args, **kwargs):
         super(_PyMCModel, self).__init__(*args, **kwargs)
 
         self.fit_complete = False
-        self.learning_model = learning_models[0]
-        self.__learning_model_initial = learning_models[1]
+        self.learning_model = learning_model
         self.observation_model = observation_model
         self.learning_parameters = learning_parameters
         self.observation_parameters = observation_parameters[0]
@@ -166,18 +241,22 @@ class _PyMCModel(Continuous):
             _initialise_parameters(self.learning_parameters, self.observation_parameters, self.n_subjects, self.n_runs,
                                    mle, hierarchical)
 
+        # repeat parameters for each run - these don't change between trials so only need to be built once
+        self.static_parameters_reshaped = [T.repeat(i, self.n_runs).astype(theano.config.floatX) for i in self.static_parameters]
+        self.dynamic_parameters_reshaped = [T.repeat(i, self.n_runs).astype(theano.config.floatX) for i in self.dynamic_parameters]
+        if self.observation_parameters[0] is not None:
+            self.observation_parameters_reshaped = [T.repeat(i.pymc_distribution, self.n_runs) for i in self.observation_parameters]
+        else:
+            self.observation_parameters_reshaped = None
+
         ## learning models with multiple outputs
         ## check number of dynamic parameters, if number of learning function outputs is longer, add nones to outputs info
 
         self.__n_dynamic = len(self.dynamic_parameters)
         self.__n_learning_returns, self.__learning_return_names = n_returns(self.learning_model)
-        self.__n_learning_returns, self.__learning_return_names = n_returns(self.learning_model)
         if self.observation_model is not None:
             self.__n_observation_returns, self.__observation_return_names = n_returns(self.observation_model)
 
-        self.responses = self.responses.T
-        if self.responses.ndim == 1:
-            self.responses = self.responses.reshape(self.responses.shape[0], 1)
         if self.logp_function == 'normal':
             # Assume that if there's no observation model we're using value as our response variable
             if self.observation_model is None:
@@ -200,6 +279,7 @@ class _PyMCModel(Continuous):
             raise TypeError("Logp arguments should be supplied as a dictionary, supplied {0}".format(type(self.logp_args)))
 
         self.logp_distribution = None
+        self._logp_cache = {}
 
 
     def get_value(self, x):
@@ -218,31 +298,15 @@ class _PyMCModel(Continuous):
         """
 
         # begin awful hack - there is probably a better way to get values on trial+1 while retaining initial value on t = 0
-        self.static_parameters_reshaped = [np.repeat(i, self.n_runs).astype('float64') for i in self.static_parameters]
-        self.dynamic_parameters_reshaped = [np.repeat(i, self.n_runs).astype('float64') for i in self.dynamic_parameters]
-        if self.observation_parameters[0] is not None:
-            self.observation_parameters_reshaped = [np.repeat(i.pymc_distribution, self.n_runs) for i in self.observation_parameters]
-        else:
-            self.observation_parameters_reshaped = None
-
-        time = T.ones_like(x) * T.arange(0, x.shape[0]).reshape((x.shape[0], 1))
+        time = T.ones(x.shape, dtype=x.dtype) * T.arange(0, x.shape[0], dtype=x.dtype).dimshuffle(0, 'x')
 
         # print([dict(input=x, taps=[-1]), dict(input=time, taps=[-1])] + self.model_inputs
 
-        model_inputs_initial = copy.deepcopy(self.model_inputs)
-        for i in model_inputs_initial:
-            i['input'] = i['input'][:1, :]
-            i.pop('taps')
-
         try:
             value, _ = scan(fn=self.learning_model,
                             sequences=[dict(input=x, taps=[-1]), dict(input=time, taps=[-1])] + self.model_inputs,
                             outputs_info=self.dynamic_parameters_reshaped + [None] * (self.__n_learning_returns - self.__n_dynamic),
                             non_sequences=self.static_parameters_reshaped)
-            _value, _ = scan(fn=self.__learning_model_initial,
-                                    sequences=[dict(input=x[:1, :]), dict(input=time[:1, :])] + model_inputs_initial,
-                             outputs_info=self.dynamic_parameters_reshaped + [None] * (self.__n_learning_returns - self.__n_dynamic),
-                             non_sequences=self.static_parameters_reshaped)
 
         except ValueError as e:
             if "None as outputs_info" in e.message:
@@ -282,17 +346,25 @@ class _PyMCModel(Continuous):
 
         if not len(value):  # TODO doesn't work if function only returns tuple of one value
             value = [value]
-            _value = [_value]
 
         value = value[:self.__n_dynamic]  # hack, for some reason non-reused outputs don't join properly
 
+        # scan only returns values from the second trial onwards, starting values are used for the first trial
         for n, v in enumerate(value):
-            value[n] = T.concatenate([_value[n], v])
+            value[n] = T.concatenate([T.shape_padleft(self.dynamic_parameters_reshaped[n]), v])
+
+        # the delta rule has a closed form, which is faster than scan for short sequences - its cost grows with the square
+        # of the number of trials though, so scan is used for longer ones
+        if self.learning_model is rescorla_wagner and not len(self.model_inputs) and self.__n_dynamic == 1 and \
+                len(self.static_parameters_reshaped) == 1:
+            closed_form = _linear_update_value(x, self.dynamic_parameters_reshaped[0], self.static_parameters_reshaped[0])
+            value[0] = ifelse(T.le(x.shape[0], _CLOSED_FORM_MAX_TRIALS), closed_form.astype(value[0].dtype), value[0])
 
         # end awful hack
-        observation_dynamics = [value[i] for i in self.__observation_dynamic_inputs]
 
         if self.observation_model is not None:
+            # outputs are picked out when the graph is built, this doesn't add anything to the compiled function
+            observation_dynamics = [value[i] for i in self.__observation_dynamic_inputs]
             prob = self.observation_model(*observation_dynamics + self.observation_parameters_reshaped)
         else:
             prob = value
@@ -311,6 +383,11 @@ class _PyMCModel(Continuous):
             Log likelihood
         """
 
+        # PyMC3 asks for the logp of the same observed variable several times (e.g. logpt and logp_nojac), reuse the
+        # graph rather than building the learning model again
+        if id(x) in self._logp_cache:
+            return self._logp_cache[id(x)][1]
+
         model_output = self.get_value(x)
 
         for arg, val in self.logp_args.items():
@@ -345,6 +422,8 @@ class _PyMCModel(Continuous):
         logp = T.switch(T.isnan(logp), 0, logp)
         logp = T.sum(logp)
 
+        self._logp_cache[id(x)] = (x, logp)  # keep a reference to x so its id isn't reused
+
         return logp
 
 
@@ -359,12 +438,19 @@ class DMModel():
         observation_model: Function defining the observation model to be used. If no observation model is used this can be indicated by providing None
         observation_parameters: A list of parameters defined using the Parameter class, given in the order expected by the observation model function. If no observation model is used this can be indicated by providing None
         name: Optional argument used for labelling the model instance
+        compile_mode: Theano mode used to compile the model for fitting and simulation. Default = 'FAST_RUN',
+                      'FAST_COMPILE' can be quicker to compile when testing models
 
     """
 
+    # attributes that belong to a built PyMC3 model, stored so the model can be reused
+    _cached_model_attributes = ('_pymc3_model', '_DMpy_model', 'params', 'responses', 'outcomes', 'theano_model_inputs',
+                                'time', 'n_runs', '_model_functions')
+
     def __init__(self, learning_model, learning_parameters, observation_model, observation_parameters,
-                 logp_function='beta', logp_args=None, name=''):
+                 logp_function='beta', logp_args=None, name='', compile_mode='FAST_RUN'):
         self.name = name
+        self.compile_mode = compile_mode
         self.learning_model = learning_model
         self.learning_parameters = learning_parameters
         self.observation_model = observation_model
@@ -415,17 +501,21 @@ class DMModel():
         if type(self.observation_parameters) is not list:
             self.observation_parameters = [self.observation_parameters]
 
-        self.__observation_dynamic_inputs = [i for i in self.observation_parameters if isinstance(i, str)]
-        self.observation_parameters = [i for i in self.observation_parameters if not isinstance(i, str)]
-
-        for n, i in enumerate(self.__observation_dynamic_inputs):
-            for nn, j in enumerate(self.learning_parameters):
-                if j.name == i:
-                    self.__observation_dynamic_inputs[n] = nn  # get the index of the relevant learning parameter
-        self.__observation_dynamic_inputs = [0] + self.__observation_dynamic_inputs  # add zero for value output
+        # dynamic inputs to the observation model are given as names of learning parameters, split these from the
+        # observation parameters
+        learning_parameter_index = dict((j.name, nn) for nn, j in enumerate(self.learning_parameters))
+        self.__observation_dynamic_inputs = [0]  # add zero for value output
+        observation_parameters = []
+
+        for i in self.observation_parameters:
+            if isinstance(i, str):
+                if i not in learning_parameter_index:
+                    raise ValueError("Observation model dynamic inputs don't match with learning model parameter names")
+                self.__observation_dynamic_inputs.append(learning_parameter_index[i])  # index of the learning parameter
+            else:
+                observation_parameters.append(i)
 
-        if any([isinstance(i, str) for i in self.__observation_dynamic_inputs]):  # check this worked
-            raise ValueError("Observation model dynamic inputs don't match with learning model parameter names")
+        self.observation_parameters = observation_parameters
 
         if self.observation_model is not None:
             n_obs_params = len(self.observation_parameters)
@@ -437,6 +527,8 @@ class DMModel():
 
         # create model
         self._pymc3_model = None
+        self._model_key = None
+        self._model_cache = OrderedDict()
 
 
     def _create_model(self, mle=False, hierarchical=False):
@@ -453,16 +545,16 @@ class DMModel():
 
         """
 
-        # record the initial state of the model, used for filling in starting values
-        self.__learning_model_initial = function_wrapper(self.learning_model, self.__n_learning_returns, self.__n_dynamic,
-                                                         len(self.model_inputs))
+        with pm.Model(theano_config={'compute_test_value': 'ignore', 'mode': self.compile_mode, 'exception_verbosity': 'high'}) as model:
 
-        with pm.Model(theano_config={'compute_test_value': 'ignore', 'mode': 'FAST_RUN', 'exception_verbosity': 'high'}) as model:
+            # building the model stores its distributions on the parameters, so each model gets its own copies
+            learning_parameters = [copy.copy(p) for p in self.learning_parameters]
+            observation_parameters = [copy.copy(p) for p in self.observation_parameters]
 
-            m = _PyMCModel('model', learning_models=(self.learning_model, self.__learning_model_initial),
-                          learning_parameters=self.learning_parameters,
+            m = _PyMCModel('model', learning_model=self.learning_model,
+                          learning_parameters=learning_parameters,
                           observation_model=self.observation_model, vars=model.vars,
-                          observation_parameters=[self.observation_parameters, self.__observation_dynamic_inputs],
+                          observation_parameters=[observation_parameters, self.__observation_dynamic_inputs],
                           responses=self.responses, observed=self.outcomes, outcomes=self.outcomes, time=self.time,
                           n_subjects=self.n_subjects, n_runs=self.n_runs, hierarchical=hierarchical, mle=mle,
                           logp_function=self.logp_function, logp_args=self.logp_args, model_inputs=self.theano_model_inputs)
@@ -477,6 +569,7 @@ class DMModel():
             # print(m.distribution.unobserved_RVs
 
         self._pymc3_model = model
+        self._model_functions = {}  # functions compiled from the model when first needed, e.g. logp for fit statistics
 
         print("Created model")
 
@@ -506,6 +599,8 @@ class DMModel():
             fit_kwargs: Dictionary of keyword arguments passed to underlying MLE, MAP and variational fitting functions. See
             PyMC3 documentation for more details (http://docs.pymc.io/notebooks/getting_started.html)
             sample_kwargs: Dictionary of keyword arguments passed to underlying variational and MCMC sampling functions.
+                           For MCMC, chains can be run in parallel by passing njobs (e.g. {'njobs': 4}), this requires
+                           the model to be picklable. By default PyMC3 samples in a single process.
             suppress_table: If set to true, parameter table will not be printed when model fitting is complete.
             model_inputs: Additional inputs to the model.
             response_transform: A function to transform the responses.
@@ -527,7 +622,7 @@ class DMModel():
             raise ValueError("No outcomes provided. Please provide outcomes either as an array or as a column in "
                              "the response file named 'Outcome'")
 
-        responses = responses.astype(float)
+        responses = responses.astype(theano.config.floatX)
         if response_transform is not None:
             if not callable(response_transform):
                 raise TypeError("Transformation for response variable should be provided as a function, provided type"
@@ -544,6 +639,8 @@ class DMModel():
         else:
             outcomes = load_outcomes(outcomes)
 
+        outcomes = np.asarray(outcomes, dtype=theano.config.floatX)
+
         self.subjects = subjects
         n_subjects = len(subjects)
 
@@ -563,33 +660,54 @@ class DMModel():
         if responses.shape[1] != outcomes.shape[0]:
             raise ValueError("Responses ({0}) and outcomes ({1}) have unequal lengths".format(responses.shape[1],
                                                                                               outcomes.shape[0]))
+
+        # transforms are applied to responses in their (subjects, trials) layout, before they're stored as
+        # (trials, subjects) to match the outcomes
+        responses = np.ascontiguousarray(np.asarray(self.response_transform(responses)).T, dtype=theano.config.floatX)
+
         if fit_method in ['MLE', 'mle']:
             mle = True
         else:
             mle = False
 
-        time = np.tile(np.arange(0, outcomes.shape[0]), (outcomes.shape[1], 1)).T
+        # trial index, this is the same for every subject so is stored as a vector and broadcast where needed
+        time = np.arange(0, outcomes.shape[0], dtype=theano.config.floatX)
+
+        # MAP, variational and MCMC fitting all use the same model, MLE needs a model with flat/uniform priors
+        model_key = (mle, n_subjects, hierarchical, len(self.model_inputs),
+                     repr([_parameter_spec(p) for p in self.learning_parameters + self.observation_parameters]))
 
-        if self._pymc3_model is None or self._fit_method != fit_method.lower() or n_subjects \
-                != self.n_subjects or self._hierarchical != hierarchical or \
-                len(self.model_inputs) != len(self.theano_model_inputs):
+        if model_key != self._model_key:
 
-            # create model if it doesn't exist, the fitting method has been changed, or number of subjects has changed
-            # turn outcomes and responses into shared variables
+            # create model if it doesn't exist, switching to or from MLE, number of subjects has changed or parameters
+            # have been changed - the most recently used models are kept so switching back to them doesn't require
+            # recompiling
 
-            self.logp_function = self.logp_function
-            self.responses = theano.shared(responses)
-            self.outcomes = theano.shared(outcomes)
-            self.theano_model_inputs = [theano.shared(i.astype(np.float64)) for i in self.model_inputs]
-            self.time = theano.shared(time)
-            self.n_subjects = n_subjects
-            self.n_runs = theano.shared(n_runs)
-            self._create_model(mle=mle, hierarchical=hierarchical)
+            if model_key in self._model_cache:
+                self._model_cache[model_key] = self._model_cache.pop(model_key)  # mark as most recently used
+                for attr, val in self._model_cache[model_key].items():
+                    setattr(self, attr, val)
 
-        self.responses.set_value(self.response_transform(responses))
+            else:
+                # turn outcomes and responses into shared variables
+                self.logp_function = self.logp_function
+                self.responses = theano.shared(responses)
+                self.outcomes = theano.shared(outcomes)
+                self.theano_model_inputs = [theano.shared(i.astype(theano.config.floatX)) for i in self.model_inputs]
+                self.time = theano.shared(time)
+                self.n_subjects = n_subjects
+                self.n_runs = theano.shared(n_runs)
+                self._create_model(mle=mle, hierarchical=hierarchical)
+                self._model_cache[model_key] = dict((attr, getattr(self, attr)) for attr in self._cached_model_attributes)
+                if len(self._model_cache) > _MODEL_CACHE_SIZE:
+                    self._model_cache.popitem(last=False)
+
+            self._model_key = model_key
+
+        self.responses.set_value(responses)
         self.outcomes.set_value(outcomes)
         for n, i in enumerate(self.theano_model_inputs):
-            i['input'].set_value(self.model_inputs[n])
+            i['input'].set_value(self.model_inputs[n].astype(theano.config.floatX))
         self.time.set_value(time)
         self.n_subjects = n_subjects
         self.n_runs.set_value(n_runs)
@@ -649,7 +767,8 @@ class DMModel():
             if plot:
                 traceplot(self.trace)
 
-        self.fit_values = pm.summary(self.trace, varnames=self.trace.varnames)['mean'].to_dict()
+        # posterior means are taken straight from the trace, summary statistics are only needed for the parameter table
+        self.fit_values = trace_means(self.trace)
 
         self.parameter_table = parameter_table(pm.summary(self.trace), self.subjects, self._DMpy_model.distribution.logp_vars)
 
@@ -707,7 +826,8 @@ class DMModel():
         if plot:
             traceplot(self.trace)
 
-        self.fit_values = pm.summary(self.trace, varnames=self.trace.varnames)['mean'].to_dict()
+        # posterior means are taken straight from the trace, summary statistics are only needed for the parameter table
+        self.fit_values = trace_means(self.trace)
 
         self.parameter_table = parameter_table(pm.summary(self.trace), self.subjects, self._DMpy_model.distribution.logp_vars)
 
@@ -768,14 +888,23 @@ class DMModel():
 
         untransformed_params = {}
 
+        # match each parameter name to its fit value, using the untransformed value where PyMC3 provides it
+        fit_value_names = {}
+        for m in self.raw_fit_values:
+            n = _TRANSFORMED_NAME_RE.search(m)
+            if n:
+                fit_value_names.setdefault(n.group(), m)
+        for m in self.raw_fit_values:
+            if '__' not in m:
+                fit_value_names[m] = m
+
         for p in self.params:
-            for m in self.raw_fit_values.keys():
-                n = re.search('.+(?=_.+__)', m)
-                if (n and n.group() == p.name) or m == p.name:
-                    if '__' in m:
-                        untransformed_params[p.name] = p.backward(self.raw_fit_values[m]).eval()
-                    else:
-                        untransformed_params[p.name] = self.raw_fit_values[m]
+            m = fit_value_names.get(p.name)
+            if m is not None:
+                if '__' in m:
+                    untransformed_params[p.name] = p.backward(self.raw_fit_values[m]).eval()
+                else:
+                    untransformed_params[p.name] = self.raw_fit_values[m]
 
         self.fit_values = untransformed_params
 
@@ -790,7 +919,11 @@ class DMModel():
             print("\nPARAMETER ESTIMATES\n")
             print(self.parameter_table)
 
-        self.log_likelihood, self.BIC, self.AIC = model_fit(self._pymc3_model.logp_nojac, self.map_estimate,
+        # logp_nojac compiles a new function each time it's accessed, so it's kept for later fits of the same model
+        if 'logp_nojac' not in self._model_functions:
+            self._model_functions['logp_nojac'] = self._pymc3_model.logp_nojac
+
+        self.log_likelihood, self.BIC, self.AIC = model_fit(self._model_functions['logp_nojac'], self.map_estimate,
                                                             self._pymc3_model.vars, self.outcomes, self.n_subjects)
 
         self.WAIC = None
@@ -850,7 +983,7 @@ class DMModel():
 
         sim_results, _ = self.simulate()
 
-        if 'P' in sim_results['sim_results'].keys():
+        if 'P' in sim_results['sim_results']:
             predicted = np.vstack(sim_results['sim_results']['P'])
         else:
             predicted = np.vstack(sim_results['sim_results']['value'])
@@ -858,10 +991,10 @@ class DMModel():
         if len(predicted.shape) == 1:
             predicted.reshape((predicted.shape, 1))
 
-        n_runs = self.n_runs.eval()
+        n_runs = int(self.n_runs.get_value())
         predicted = predicted.reshape(n_runs * predicted.shape[0], predicted.shape[1] / n_runs, order='F')
 
-        true = self.responses.eval().T
+        true = self.responses.get_value(borrow=True)
         true = true.reshape(n_runs * true.shape[0], true.shape[1] / n_runs, order='F')
 
         # TODO REDO ALL THIS
@@ -888,7 +1021,7 @@ class DMModel():
                 logp_results[k].append(result)
             logp_results[k] = np.array(logp_results[k])
 
-        o = self.outcomes.eval()
+        o = self.outcomes.get_value(borrow=True)
         o = true.reshape(n_runs * o.shape[0], o.shape[1] / n_runs)
 
         if self.logp_function == 'r2' or data_type == 'continous':
@@ -901,8 +1034,8 @@ class DMModel():
 
 
         fit_table = dict(subject=self.subjects, BIC=self.BIC_individual, AIC=self.AIC_individual)
-        for k in logp_results.keys():
-            fit_table[k] = logp_results[k]
+        for k, v in logp_results.items():
+            fit_table[k] = v
 
         fit_table = pd.DataFrame(fit_table)
 
@@ -928,7 +1061,7 @@ class DMModel():
     def simulate(self, outcomes=None, learning_parameters=None, observation_parameters=None, plot=False,
                  output_file='', n_subjects=1, return_choices=False, combinations=False,
                  plot_against_true=False, noise_mean=0, noise_sd=0, model_inputs=None,
-                 response_variable='prob'):
+                 response_variable='prob', n_jobs=1, fast=False):
 
         """
         Args:
@@ -946,6 +1079,8 @@ class DMModel():
             noise_sd: Sets the standard deviation of the noise distribution. Default = 0, increasing this will add noise.
             model_inputs: List of column names to use as additional inputs for the model. This requires the outcomes to be in dataframe format.
             response_variable: The output of the model to be used as the subject's response when producing a dataframe of the simulated results. The given variable will be renamed "Responses" in the dataframe and this will be used if performing parameter recovery on the simulated data. Default="prob".
+            n_jobs: Number of processes to split the simulated subjects across. If None, one process is used per CPU. Not used with fast simulation, which already runs all subjects at once. Default = 1
+            fast: If true and the learning model is rescorla_wagner, the learning model is run in a NumPy loop over trials rather than a Theano scan, which avoids compiling the simulation function. Default = False
 
         Returns:
             Tuple: (simulated results, output path), where simulated results is an instance of the SimulatedResults class
@@ -960,7 +1095,7 @@ class DMModel():
             model_inputs = []
 
         # Check that we either have parameters provided or the model has been fit
-        if learning_parameters == None and not self.fit_complete:
+        if learning_parameters is None and not self.fit_complete:
             raise ValueError("No parameter values provided and model has not been fit. Must explicitly "
                              "provide parameter values for simulation or fit the model first")
 
@@ -971,6 +1106,10 @@ class DMModel():
             raise KeyError("The provided response variable ('{0}') is not one of the outputs returned by either the "
                            "learning or observation model. Possible outputs are {1}".format(response_variable, return_names))
 
+        # Observation parameters only need handling if there is an observation model that takes parameters
+        has_observation = self.observation_model is not None and \
+                          any(i is not None for i in self.observation_parameters)
+
         # Using user-defined parameter values & outcomes
 
         if not self.fit_complete:  # We're using user-specified parameter values
@@ -1007,38 +1146,37 @@ class DMModel():
             params_from_fit = True  # use best values from model fitting if parameter values aren't provided
 
             # Get necessary info from existing class attributes
-            n_runs = self.n_runs.eval()
+            n_runs = int(self.n_runs.get_value())
             n_subjects = self.n_subjects
-            outcomes = self.outcomes.eval()
+            outcomes = self.outcomes.get_value(borrow=True)
             model_inputs = self.model_inputs
 
             self.sim_learning_parameters = OrderedDict()
             self.sim_observation_parameters = OrderedDict()
 
-            learning_parameter_names = [i.name for i in self.learning_parameters]
-            if self.observation_parameters[0] is not None:
-                observation_parameter_names = [i.name for i in self.observation_parameters]
+            # Parameters by name, so that values can be matched to parameters without searching the parameter lists
+            learning_parameter_lookup = OrderedDict((i.name, i) for i in self.learning_parameters)
+            if has_observation:
+                observation_parameter_lookup = OrderedDict((i.name, i) for i in self.observation_parameters)
             else:
-                observation_parameter_names = None
+                observation_parameter_lookup = OrderedDict()
 
             # Get fitted parameter values from parameter table
             for p in self.parameter_table.columns:
-                if p.replace('mean_', '') in learning_parameter_names:
-                    self.sim_learning_parameters[p.replace('mean_', '')] = np.repeat(self.parameter_table[p].values, n_runs)
+                name = p.replace('mean_', '')
+                if name in learning_parameter_lookup:
+                    self.sim_learning_parameters[name] = np.repeat(self.parameter_table[p].values, n_runs)
 
-                elif observation_parameter_names is not None and p.replace('mean_', '') in observation_parameter_names:
-                    self.sim_observation_parameters[p.replace('mean_', '')] = np.repeat(self.parameter_table[p].values, n_runs)
+                elif name in observation_parameter_lookup:
+                    self.sim_observation_parameters[name] = np.repeat(self.parameter_table[p].values, n_runs)
 
-            for p in learning_parameter_names:
-                if p not in self.sim_learning_parameters.keys():
-                    mean = [i.mean for i in self.learning_parameters if i.name == p]
-                    self.sim_learning_parameters[p] = np.repeat(mean, n_runs * n_subjects)
+            for p, i in learning_parameter_lookup.items():
+                if p not in self.sim_learning_parameters:
+                    self.sim_learning_parameters[p] = np.repeat(i.mean, n_runs * n_subjects)
 
-            if observation_parameter_names is not None:
-                for p in observation_parameter_names:
-                    if p not in self.sim_observation_parameters.keys():
-                        mean = [i.mean for i in self.observation_parameters if i.name == p]
-                        self.sim_observation_parameters[p] = np.repeat(mean, n_runs * n_subjects)
+            for p, i in observation_parameter_lookup.items():
+                if p not in self.sim_observation_parameters:
+                    self.sim_observation_parameters[p] = np.repeat(i.mean, n_runs * n_subjects)
 
         # Create parameter combinations
 
@@ -1052,68 +1190,68 @@ class DMModel():
                 self.sim_observation_parameters[p] = [v]
 
         # combine learning and observation parameters into a single list - necessary for creating combinations/pairs
-        self.__parameter_values = list(self.sim_learning_parameters.values()) + list(self.sim_observation_parameters.values())
+        self.__parameter_values = list(chain(self.sim_learning_parameters.values(), self.sim_observation_parameters.values()))
 
         # Get combinations
         p_combinations, n_subjects = self._create_parameter_combinations(combinations, self.__parameter_values, n_runs,
                                                                          n_subjects, params_from_fit)
 
-        # put combinations of parameters back into dictionaries
-        for n, p in enumerate(list(self.sim_learning_parameters.keys()) + list(self.sim_observation_parameters.keys())):
-            if p in self.sim_learning_parameters.keys():
-                self.sim_learning_parameters[p] = p_combinations[:, n]
+        # Store combinations as a single floatX array with one column per parameter - the dictionaries hold views of
+        # its columns rather than separate copies. Fortran order keeps each column contiguous in memory
+        self._sim_params = np.asfortranarray(p_combinations, dtype=theano.config.floatX)
+        self._sim_param_names = list(chain(self.sim_learning_parameters, self.sim_observation_parameters))
+        sim_param_columns = dict((p, n) for n, p in enumerate(self._sim_param_names))
+
+        for n, p in enumerate(self._sim_param_names):
+            if p in self.sim_learning_parameters:
+                self.sim_learning_parameters[p] = self._sim_params[:, n]
             else:
-                self.sim_observation_parameters[p] = p_combinations[:, n]
+                self.sim_observation_parameters[p] = self._sim_params[:, n]
 
-        # each parameter now has a list of values
+        # each parameter now has an array of values
 
         # Set up parameters
-        # Parameters need to be given to scan as arrays - here we take them out of their dictionaries and make sure
-        # they're in the correct format (i.e. float64)
+        # Parameters need to be given to scan as floatX arrays - here we take the relevant columns of the parameter array
 
         sim_dynamic = []
         sim_static = []
         sim_observation = []
 
-        for n, i in enumerate(self.learning_parameters):
-            match = False
-            for p, v in self.sim_learning_parameters.items():
-                if p == i.name:
-                    if i.dynamic:
-                        sim_dynamic.append(np.float64(v))
-                    else:
-                        sim_static.append(np.float64(v))
-                    match = True
-            if not match:
+        for i in self.learning_parameters:
+            if i.name not in self.sim_learning_parameters:
                 raise ValueError("Parameter {0} has no value provided".format(i.name))
+            if i.dynamic:
+                sim_dynamic.append(self._sim_params[:, sim_param_columns[i.name]])
+            else:
+                sim_static.append(self._sim_params[:, sim_param_columns[i.name]])
 
-        if self.observation_model is not None:
+        if has_observation:
             for i in self.observation_parameters:
-                match = False
-                for p, v in self.sim_observation_parameters.items():
-                    if i.name == p:
-                        sim_observation.append(v)
-                        match = True
-                if not match:
+                if i.name not in self.sim_observation_parameters:
                     raise ValueError("Parameter {0} has no value provided".format(i.name))
+                sim_observation.append(self._sim_params[:, sim_param_columns[i.name]])
+
 
+        # Range of the outcomes, used to bound noisy responses - taken before the outcomes are repeated for each subject
+        outcome_min, outcome_max = np.min(outcomes), np.max(outcomes)
 
         # Ensure outcomes and additional model inputs are the right format
         if outcomes.shape[1] < p_combinations.shape[0]:
             warnings.warn("Fewer outcome lists than simulated subjects, attempting to use same outcomes for each "
                           "subject (number of outcome lists = {0}, number of subjects = {1}".format(outcomes.shape[0],
                                                                                                     p_combinations.shape[0]), Warning)
-            try:
-                # Try to repeat the outcomes we have
-                outcomes = np.tile(outcomes, (1, p_combinations.shape[0] / outcomes.shape[1]))
-                for n in range(len(model_inputs)):
-                    model_inputs[n] = np.tile(model_inputs[n], (1, p_combinations.shape[0] / model_inputs[n].shape[1]))
-            except:
+            n_repeats, remainder = divmod(p_combinations.shape[0], outcomes.shape[1])
+            if remainder:
                 raise ValueError("Unable to repeat outcome arrays to match number of subjects, make sure to either "
                                  "provide outcomes for each subject in a dataframe or make sure the number of "
                                  "simulated subjects is divisible by the number of outcomes. Number of outcome arrays"
                                  " = {0}, number of simulated subjects = {1}".format(outcomes.shape[1], p_combinations.shape[0]))
 
+            # Repeat the outcomes we have
+            outcomes = np.tile(outcomes, (1, n_repeats))
+            for n in range(len(model_inputs)):
+                model_inputs[n] = np.tile(model_inputs[n], (1, p_combinations.shape[0] // model_inputs[n].shape[1]))
+
         if not outcomes.shape[1] == p_combinations.shape[0]:
             raise ValueError("Number of outcome lists provided does not match number of subjects")
 
@@ -1125,16 +1263,46 @@ class DMModel():
         # simulation and speeds the process up a lot
 
         # Define the simulation function if it doesn't already exist
+        # Inputs use theano's floatX, so setting floatX to float32 halves the memory used by simulation
+        outcomes = np.asarray(outcomes, dtype=theano.config.floatX)
+        model_inputs = [np.asarray(i, dtype=theano.config.floatX) for i in model_inputs]
         outputs_info = sim_dynamic + [None] * (self.__n_learning_returns - len(sim_dynamic))
-        time = np.tile(np.arange(0, outcomes.shape[0]), (outcomes.shape[1], 1)).T
+        time = np.tile(np.arange(0, outcomes.shape[0], dtype=theano.config.floatX), (outcomes.shape[1], 1)).T
+
+        fast = fast and self.learning_model is rescorla_wagner
+
+        if fast and n_jobs != 1:
+            warnings.warn("n_jobs is ignored when fast simulation is used, set fast=False to simulate in parallel")
 
-        if self._simulate_function == None:
+        if self._simulate_function is None and not fast:
             self._define_simulate_function(outputs_info, sim_static, model_inputs, sim_observation)
 
         # Call the function
-        sim_data = self._simulate_function(outcomes, time, *(model_inputs + [i for i in sim_static] +
-                                                             [i for i in outputs_info if i is not None] +
-                                                             sim_observation))
+        sim_inputs = [outcomes, time] + model_inputs + sim_static + [i for i in outputs_info if i is not None] + \
+                     sim_observation
+
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = min(n_jobs, outcomes.shape[1])
+
+        if fast:
+            sim_data = self._simulate_fast(outcomes, time, model_inputs, sim_static, outputs_info, sim_observation)
+
+        elif n_jobs > 1:
+            # Subjects are simulated independently, so split them into one chunk per process - matrices are split
+            # along their subject axis, parameter vectors along their only axis
+            n_matrices = 2 + len(model_inputs)
+            chunks = zip(*[np.array_split(v, n_jobs, axis=1 if n < n_matrices else 0) for n, v in enumerate(sim_inputs)])
+
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_simulate_worker, initargs=(self._simulate_function,))
+            try:
+                sim_data = np.concatenate(pool.map(_simulate_chunk, chunks), axis=2)
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            sim_data = self._simulate_function(*sim_inputs)
 
 
         # Rename duplicate return names
@@ -1151,16 +1319,18 @@ class DMModel():
 
         # Check for nans and flatten
         for r, v in self._simulation_results_dict.items():
-            if np.any(np.isnan(v)):
-                warnings.warn("NaNs present in {0}".format(r))
-            if np.any(np.isinf(v)):
-                warnings.warn("Infs present in {0}".format(r))
-            else:
-                self._simulation_results_dict[r] = flatten_simulated(v)
+            # single pass in the usual case where every value is finite, only look for the cause otherwise
+            if not np.isfinite(v).all():
+                if np.any(np.isnan(v)):
+                    warnings.warn("NaNs present in {0}".format(r))
+                if np.any(np.isinf(v)):
+                    warnings.warn("Infs present in {0}".format(r))
+                    continue
+            self._simulation_results_dict[r] = flatten_simulated(v)
 
         # Convert simulation results to a pandas dataframe
         if self.fit_complete:
-            true_responses = self.responses.eval()
+            true_responses = self.responses.get_value(borrow=True).T
         else:
             true_responses = None
         self.simulation_results = simulated_dataframe(self._simulation_results_dict, outcomes, true_responses,
@@ -1177,11 +1347,13 @@ class DMModel():
                                                                                                    noise_mean,
                                                                                                    noise_sd))
             self.simulation_results[response_variable] = _add_noise(self.simulation_results[response_variable],
-                                                                    noise_mean, noise_sd, lower_bound=np.min(outcomes),
-                                                                    upper_bound=np.max(outcomes))
+                                                                    noise_mean, noise_sd, lower_bound=outcome_min,
+                                                                    upper_bound=outcome_max)
 
         # Set response variable
-        if self.logp_function == 'bernoulli' or return_choices:
+        choices = self.logp_function == 'bernoulli' or return_choices
+
+        if choices:
             self.simulation_results['Response'] = generate_choices2(self.simulation_results[response_variable])
 
         else:
@@ -1189,6 +1361,11 @@ class DMModel():
 
         self._recovery_run = False
 
+        self.simulation = SimulationResults(self.simulation_results, learning_parameters, observation_parameters,
+                                            response_variable, self.__learning_returns, self.__observation_returns,
+                                            outcomes, n_subjects, n_runs, self.fit_complete, true_responses,
+                                            choices=choices)
+
         # Plots
 
         if plot:
@@ -1203,10 +1380,6 @@ class DMModel():
         if len(output_file):
             self.simulation_results.to_csv(output_file, index=False)
 
-        self.simulation = SimulationResults(self.simulation_results, learning_parameters, observation_parameters,
-                                            response_variable, self.__learning_returns, self.__observation_returns,
-                                            outcomes, n_subjects, n_runs, self.fit_complete, self.responses)
-
         return self.simulation, output_file
 
 
@@ -1216,23 +1389,20 @@ class DMModel():
             # Remove any duplicates
             for n, i in enumerate(parameter_values):
                 parameter_values[n] = list(set(i))
-            p_combinations = np.array(list(product(*parameter_values)))  # get product
-            n_combinations = p_combinations.shape[0]
-            p_combinations = np.repeat(p_combinations, n_runs, axis=0)
-            p_combinations = np.tile(p_combinations, (n_subjects, 1))
+            p_combinations = cartesian_product(parameter_values)
 
         else:  # get pairs of parameters
-            p_combinations = []
             if not all(len(i) == len(parameter_values[0]) for i in parameter_values):
                 raise ValueError("Each parameter should have the same number of values")
-            else:
-                for i in range(len(parameter_values[0])):
-                    p_combinations.append([j[i] for j in parameter_values])
-            p_combinations = np.array(p_combinations)
-            n_combinations = p_combinations.shape[0]
-            if not params_from_fit:
-                p_combinations = np.repeat(p_combinations, n_runs, axis=0)
-                p_combinations = np.tile(p_combinations, (n_subjects, 1))
+            p_combinations = np.column_stack(parameter_values)
+
+        n_combinations = p_combinations.shape[0]
+
+        # Repeat each combination for every run, then for every subject - done with a single row index so the
+        # expanded array is only allocated once
+        if combinations or not params_from_fit:
+            rows = np.tile(np.repeat(np.arange(n_combinations), n_runs), n_subjects)
+            p_combinations = p_combinations[rows]
 
         # New n_subjects = number of subjects * number of parameter combinations
         if not params_from_fit:
@@ -1250,13 +1420,23 @@ class DMModel():
 
         """
 
+        # compiled functions are shared between model instances that use the same model functions and inputs
+        cache_key = (self.learning_model, self.observation_model, tuple(i is None for i in outputs_info), len(sim_static),
+                     len(model_inputs), len(sim_observation), tuple(self.__observation_dynamic_inputs),
+                     theano.config.floatX, self.compile_mode)
+
+        if cache_key in _simulate_function_cache:
+            self._simulate_function = _simulate_function_cache[cache_key]
+            return
+
         sim_static = [np.array([i]) if not isinstance(i, np.ndarray) else i for i in sim_static]
         outputs_info = [np.array([i]) if not isinstance(i, np.ndarray) and i is not None else i for i in outputs_info]
 
         # define theano tensors
-        time_theano = T.matrix("time", dtype='float64')
-        outcomes_theano = T.matrix("outcomes", dtype='float64')
-        model_inputs_theano = [T.matrix("model_input_{0}".format(n), dtype='float64') for n in range(len(model_inputs))]
+        time_theano = T.matrix("time", dtype=theano.config.floatX)
+        outcomes_theano = T.matrix("outcomes", dtype=theano.config.floatX)
+        model_inputs_theano = [T.matrix("model_input_{0}".format(n), dtype=theano.config.floatX)
+                               for n in range(len(model_inputs))]
         sim_static_theano = []
         outputs_info_theano = []
         sim_observation_theano = []
@@ -1265,12 +1445,12 @@ class DMModel():
             if i is None:
                 outputs_info_theano.append(None)
             else:
-                outputs_info_theano.append(T.vector("outputs_info_{0}".format(n), dtype='float64'))
+                outputs_info_theano.append(T.vector("outputs_info_{0}".format(n), dtype=theano.config.floatX))
 
         for n, i in enumerate(sim_static):
-            sim_static_theano.append(T.vector("sim_static_{0}".format(n), dtype='float64'))
+            sim_static_theano.append(T.vector("sim_static_{0}".format(n), dtype=theano.config.floatX))
         for n, i in enumerate(sim_observation):
-            sim_observation_theano.append(T.vector("sim_observation_{0}".format(n), dtype='float64'))
+            sim_observation_theano.append(T.vector("sim_observation_{0}".format(n), dtype=theano.config.floatX))
         # sequences for scan should be in format (n_trials, n_subjects)
 
         # Run the learning model
@@ -1280,10 +1460,11 @@ class DMModel():
                               outputs_info=outputs_info_theano,
                               non_sequences=sim_static_theano)
 
-        # Not sure what this does but it's probably important
+        # scan returns recurrent outputs after each trial's update - shift them by one trial so the starting value is
+        # used for the first trial, joined in a single op
         for n, i in enumerate(outputs_info_theano):
             if i is not None:
-                value[n] = T.vertical_stack(i.reshape((1, i.shape[0])), value[n][:-1, :])
+                value[n] = T.concatenate([T.shape_padleft(i), value[n][:-1]])
 
         # Run the observation model
         # TODO change this so it returns a list rather than P + [obs outs] - change documentation
@@ -1300,7 +1481,57 @@ class DMModel():
                                                          sim_static_theano +
                                                          [i for i in outputs_info_theano if i is not None] +
                                                          sim_observation_theano,
-                                                  outputs=out, updates=updates)
+                                                  outputs=out, updates=updates, mode=self.compile_mode)
+        _simulate_function_cache[cache_key] = self._simulate_function
+
+
+    def _simulate_fast(self, outcomes, time, model_inputs, sim_static, outputs_info, sim_observation):
+
+        """
+        Simulates data from the model without compiling a scan loop. The learning model is called once per trial on
+        NumPy arrays holding every subject, which only works for learning models made up of plain arithmetic (currently
+        rescorla_wagner). Outputs are in the same format as those of the compiled simulation function
+
+        """
+
+        n_trials = outcomes.shape[0]
+
+        recurrent = [n for n, i in enumerate(outputs_info) if i is not None]
+        state = [outputs_info[n] for n in recurrent]
+        value = [np.empty(outcomes.shape, dtype=outcomes.dtype) for _ in outputs_info]
+
+        for t in range(n_trials):
+            # as in the scan version, recurrent outputs are given as the value before the update on each trial
+            for n, v in zip(recurrent, state):
+                value[n][t] = v
+            outs = self.learning_model(outcomes[t], time[t], *([i[t] for i in model_inputs] + state + sim_static))
+            for n, o in enumerate(outs):
+                if n not in recurrent:
+                    value[n][t] = o
+            state = [outs[n] for n in recurrent]
+
+        # Run the observation model
+        if self.observation_model is not None:
+            cache_key = ('observation', self.observation_model, tuple(self.__observation_dynamic_inputs),
+                         len(sim_observation), theano.config.floatX, self.compile_mode)
+
+            if cache_key not in _simulate_function_cache:
+                dynamic_theano = [T.matrix("dynamic_{0}".format(n), dtype=theano.config.floatX)
+                                  for n in range(len(self.__observation_dynamic_inputs))]
+                sim_observation_theano = [T.vector("sim_observation_{0}".format(n), dtype=theano.config.floatX)
+                                          for n in range(len(sim_observation))]
+                obs_outs = self.observation_model(*dynamic_theano + sim_observation_theano)
+                _simulate_function_cache[cache_key] = theano.function(inputs=dynamic_theano + sim_observation_theano,
+                                                                      outputs=T.as_tensor_variable(list(obs_outs)),
+                                                                      mode=self.compile_mode)
+
+            obs_outs = _simulate_function_cache[cache_key](*[value[i] for i in self.__observation_dynamic_inputs] +
+                                                           sim_observation)
+
+        else:
+            obs_outs = []
+
+        return np.stack(value + list(obs_outs))
 
 
     def recovery(self, correlations=True, by=None):
@@ -1323,10 +1554,18 @@ class DMModel():
                                             on='Subject')
             self._recovery_run = True
         print("Performing parameter recovery tests...")
-        parameter_values = []
-        parameter_values_sim = []
         n_p_free = len(fit_params)
 
+        for p in fit_params:
+            if p.replace('mean_', '') + '_sim' not in self.sims.columns:
+                raise ValueError("Simulated values for parameter {0} not found in response file".format(p))
+
+        # Estimated and simulated values with one column per parameter, so R2 and correlations can be calculated for
+        # every parameter at once
+        parameter_values = self.parameter_table[fit_params].values
+        parameter_values_sim = self.parameter_table[[p.replace('mean_', '') + '_sim' for p in fit_params]].values
+        parameter_r2 = r2_score(parameter_values_sim, parameter_values, multioutput='raw_values')
+
         fontweight = 'normal'
 
         if by is not None and by not in self.parameter_table.columns:
@@ -1340,11 +1579,6 @@ class DMModel():
         # SCATTER PLOTS - CORRELATIONS
         f, axarr = plt.subplots(1, n_p_free, figsize=(2.5 * n_p_free, 3))
         for n, p in enumerate(fit_params):  # this code could all be made far more efficient
-            if p.replace('mean_', '') + '_sim' not in self.sims.columns:
-                raise ValueError("Simulated values for parameter {0} not found in response file".format(p))
-            parameter_values.append(self.parameter_table[p])
-            a = p.replace('mean_', '') + '_sim'
-            parameter_values_sim.append(self.parameter_table[p.replace('mean_', '') + '_sim'])
             if n_p_free > 1:
                 ax = axarr[n]
             else:
@@ -1378,8 +1612,7 @@ class DMModel():
             ax.set_xlabel('Simulated {0}'.format(p), fontweight=fontweight)
             ax.set_ylabel('Estimated {0}'.format(p), fontweight=fontweight)
             ax.set_title('{0}\n'
-                         'R2 = {1}'.format(p, np.round(r2_score(self.parameter_table[p.replace('mean_', '') + '_sim'],
-                                                          self.parameter_table[p]), 2)), fontweight=fontweight)
+                         'R2 = {1}'.format(p, np.round(parameter_r2[n], 2)), fontweight=fontweight)
 
             sim_min = np.min(self.parameter_table[p.replace('mean_', '') + '_sim'])
             sim_max = np.max(self.parameter_table[p.replace('mean_', '') + '_sim'])
@@ -1398,13 +1631,13 @@ class DMModel():
 
         ## SIMULATED-POSTERIOR CORRELATIONS
         if len(self.parameter_table) > 1 and correlations:
-            if np.sum(np.diff(parameter_values_sim)) == 0:
+            if np.sum(np.diff(parameter_values_sim.T)) == 0:
                 warnings.warn("Parameter values used across simulations are identical, unable to calculate "
                               "correlations between simulated and estimated parameter values. Try providing a "
                               "range of parameter values when simulating.")
                 se_cor = None
             else:
-                se_cor = np.corrcoef(parameter_values, parameter_values_sim)[n_p_free:, :n_p_free]
+                se_cor = np.corrcoef(parameter_values, parameter_values_sim, rowvar=False)[n_p_free:, :n_p_free]
                 fig, ax = plt.subplots(figsize=(n_p_free * 1.2, n_p_free * 1))
                 cmap = sns.diverging_palette(220, 10, as_cmap=True)
                 sns.heatmap(se_cor, cmap=cmap, square=True, linewidths=.5, xticklabels=fit_params,
@@ -1416,7 +1649,8 @@ class DMModel():
                 plt.tight_layout()
 
             ## POSTERIOR CORRELATIONS
-            ee_cor = np.corrcoef(parameter_values, parameter_values)[n_p_free:, :n_p_free]
+            # corrcoef returns a scalar when there's only one parameter, the heatmap needs a matrix
+            ee_cor = np.atleast_2d(np.corrcoef(parameter_values, rowvar=False))
             fig, ax = plt.subplots(figsize=(n_p_free * 1.2, n_p_free * 1))
             cmap = sns.diverging_palette(220, 10, as_cmap=True)
             sns.heatmap(ee_cor, cmap=cmap, square=True, linewidths=.5, xticklabels=fit_params,
@@ -1494,7 +1728,7 @@ class SimulationResults():
     """
 
     def __init__(self, results, learning_param_values, observation_param_values, response_variable, learning_returns,
-                 observation_returns, outcomes, n_subjects, n_runs, fit_complete, responses):
+                 observation_returns, outcomes, n_subjects, n_runs, fit_complete, responses, choices=False):
 
         self.results = results
         self.learning_param_values = learning_param_values
@@ -1507,6 +1741,7 @@ class SimulationResults():
         self.n_runs = n_runs
         self.fit_complete = fit_complete
         self.responses = responses
+        self.choices = choices  # whether the Response column holds choices generated from the response variable
 
         # Convert tensors to numpy arrays
         if not isinstance(self.outcomes, np.ndarray):
@@ -1535,46 +1770,58 @@ class SimulationResults():
             # Sublots = number of unique parameter combinations X number of runs
             if len(output):
 
-                f, ax = plt.subplots(len(output), self.n_runs, figsize=(6 * self.n_runs, 1.5 * len(output)))
+                f, ax = plt.subplots(len(output), self.n_runs, figsize=(6 * self.n_runs, 1.5 * len(output)),
+                                     squeeze=False)
+
+                pal = sns.color_palette(palette, self.n_subjects)
+
+                # Iterate over runs - run labels are strings for simulations from user-supplied parameter values and
+                # integers for simulations from fitted models, so the labels in the results are used directly
+                for r, run in enumerate(self.results.Run.unique()):
 
-                # Iterate over outputs
-                for n, name in enumerate(output):
+                    run_results = self.results[self.results.Run == run]
+                    n_run_subjects = run_results.Subject.unique().shape[0]
 
-                    # Iterate over runs
-                    for run in range(self.n_runs):
+                    # Iterate over outputs
+                    for n, name in enumerate(output):
 
-                        pal = sns.color_palette(palette, self.n_subjects)
+                        # One row per subject - rows are ordered by subject, then trial
+                        values = run_results[name].values.reshape(n_run_subjects, -1)
+                        trials = np.broadcast_to(np.arange(0, values.shape[1]), values.shape)
 
-                        # Plot values
-                        ax[n, run].plot(self.results[name][self.results.Run == run], label=name, c=pal[n])
+                        # Plot values - every subject's trajectory is drawn as part of a single collection
+                        ax[n, r].add_collection(LineCollection(np.stack([trials, values], axis=-1), label=name,
+                                                              colors=[pal[n]]))
 
                         if plot_clean and '{0}_clean'.format(name) in self.results.columns:
-                            ax[n, run].plot(self.results['{0}_clean'.format(name)][self.results.Run == run],
-                                            label=name, c=pal[n])
+                            clean_values = run_results['{0}_clean'.format(name)].values.reshape(values.shape)
+                            ax[n, r].add_collection(LineCollection(np.stack([trials, clean_values], axis=-1),
+                                                                  label=name, colors=[pal[n]]))
 
-                        ax[n, run].set_title('{0} - Run {1}'.format(name, run), fontweight='bold')
+                        ax[n, r].set_title('{0} - Run {1}'.format(name, r), fontweight='bold')
 
                         if name == self.response_variable and plot_choices:
-                            # Generate and plot choices based on response variable
-                            ax[n, run].scatter(np.arange(0, self.results[name][self.results.Run == run]),
-                                               generate_choices2(self.results[name][self.results.Run == run]), color='#72a23b',
-                                         alpha=0.5, label='Simulated choices')
+                            # Plot choices based on response variable, reusing those generated in simulation
+                            if self.choices:
+                                run_choices = run_results['Response'].values
+                            else:
+                                run_choices = generate_choices2(values.ravel())
+                            ax[n, r].scatter(trials.ravel(), run_choices, color='#72a23b',
+                                            alpha=0.5, label='Simulated choices')
 
                         if plot_outcomes:
                             # Plot task outcomes
-                            ax[n, run].scatter(np.arange(0, self.results[name][self.results.Run == run]),
-                                               self.results['Outcome'][self.results.Run == run], color='#72a23b',
-                                         alpha=0.5, label='Outcomes')
+                            ax[n, r].scatter(trials.ravel(), run_results['Outcome'].values, color='#72a23b',
+                                            alpha=0.5, label='Outcomes')
 
                         # Set x and y limits
-                        ax[n, run].set_ylim(np.min(self.results[name][self.results.Run == run]) - 0.5,
-                                               np.max(self.results[name][self.results.Run == run]) + 0.2)
-                        ax[n, run].set_xlim(0, self.results[name][self.results.Run == run].shape[0])
+                        ax[n, r].set_ylim(np.min(values) - 0.5, np.max(values) + 0.2)
+                        ax[n, r].set_xlim(0, values.shape[1])
 
-                        ax[n, run].set_xlabel("Trial")
+                        ax[n, r].set_xlabel("Trial")
 
                         if legend:
-                            ax[n, run].legend(frameon=True, fancybox=True)
+                            ax[n, r].legend(frameon=True, fancybox=True)
 
                 plt.tight_layout()
 
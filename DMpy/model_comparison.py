@@ -11,7 +11,7 @@ def model_comparison(models, measure='logp', individual=True):
     if len(models) <2:
         raise ValueError("Must provide at least two models for model comparison, {0} models provided".format(len(models)))
 
-    if not all([m.fit_complete for m in models]):
+    if not all(m.fit_complete for m in models):
         raise AttributeError("At least one model has not been fit, ensure all models have been fit before comparing models")
 
     if np.any(np.diff([m.n_subjects for m in models]) > 0):
@@ -123,11 +123,11 @@ def combine_fits_func(fits, dir, sim=False, responses=None):
     fname = ''
 
     for n, f in enumerate(fits):
-        print "Loading fit chunk {0} of {1}".format(n+1, len(fits))
+        print("Loading fit chunk {0} of {1}".format(n+1, len(fits)))
         with open(f, 'rb') as p:
             unpickled_fits.append(dill.load(p))
 
-    print "Loaded fits"
+    print("Loaded fits")
 
     fits = sum(unpickled_fits, [])  # collapse list
     if sim:
@@ -139,12 +139,12 @@ def combine_fits_func(fits, dir, sim=False, responses=None):
         out_df = pd.concat([f.parameter_table for f in fits])
         fname = os.path.join(dir, 'parameter_table_{0}.csv'.format(datetime))
         out_df.to_csv(fname)
-        print "Written csv"
+        print("Written csv")
 
     fits_fname = os.path.join(dir, 'model_fits_{0}'.format(datetime))
     with open(fits_fname, 'wb') as f:
         dill.dump(fits, f)
-    print "Saved fits"
+    print("Saved fits")
 
     return fits_fname, fname
 
@@ -194,9 +194,9 @@ class ParallelFit(object):
 
         if self.chunk_size > 1:
             self.outcomes_responses_combined = [self.outcomes_responses_combined[i:i + self.chunk_size] for i in
-                                       xrange(0, len(self.outcomes_responses_combined), self.chunk_size)]
+                                       range(0, len(self.outcomes_responses_combined), self.chunk_size)]
             self.pickled_models_combined = [self.pickled_models_combined[i:i + self.chunk_size] for i in
-                                       xrange(0, len(self.pickled_models_combined), self.chunk_size)]
+                                       range(0, len(self.pickled_models_combined), self.chunk_size)]
 
 
     def run(self, **kwargs):
@@ -206,9 +206,9 @@ class ParallelFit(object):
                                                          output_names=['fits'],
                                                          function=RL_parallel_fit_func),
                                  iterfield=['model', 'outcomes_responses'])
-        print "ITERFIELDS"
-        print len(self.pickled_models_combined)
-        print len(self.outcomes_responses_combined)
+        print("ITERFIELDS")
+        print(len(self.pickled_models_combined))
+        print(len(self.outcomes_responses_combined))
         RL_parallel_fit.inputs.model = self.pickled_models_combined
         RL_parallel_fit.inputs.outcomes_responses = self.outcomes_responses_combined
         RL_parallel_fit.inputs.fit_method = self.method
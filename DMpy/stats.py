@@ -20,14 +20,9 @@ def dic(trace, model=None):
     `float` representing the deviance information criterion of the model and trace
     """
 
-    print "A"
     model = modelcontext(model)
-    print "B"
     mean_deviance = -2 * np.mean([model.logp(pt) for pt in trace])
-    print "C"
     free_rv_means = {rv.name: trace[rv.name].mean(
         axis=0) for rv in model.free_RVs}
-    print "D"
     deviance_at_mean = -2 * model.logp(free_rv_means)
-    print "E"
     return 2 * mean_deviance - deviance_at_mean
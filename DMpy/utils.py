@@ -1,17 +1,30 @@
 import numpy as np
+import theano
 import theano.tensor as T
 from pymc3 import Model, Normal, HalfNormal, DensityDist, Potential, Bound, Uniform, fit, sample_approx, \
     Flat, Deterministic
 import warnings
 import inspect
+import ast
+import math
 import re
 import pandas as pd
 import sys
 import os
 from io import BytesIO as StringIO
 import contextlib
+from collections import OrderedDict
+from scipy.special import expit
 # from urllib.request import urlopen
 import copy
+try:
+    from functools import lru_cache
+except ImportError:  # python 2
+    from functools32 import lru_cache
+
+# matches the parameter name in names of subject-level variables, e.g. alpha in alpha__0
+_PARAMETER_NAME_RE = re.compile('(.+)(?=__)')
+
 
 def get_transforms(bounded_parameter):
 
@@ -19,6 +32,16 @@ def get_transforms(bounded_parameter):
            bounded_parameter.pymc_distribution.transformation.forward
 
 
+@lru_cache(maxsize=None)
+def _bounded_normal(lower=None, upper=None):
+
+    # bounded distributions are shared between parameters with the same bounds rather than being created for each one,
+    # only the bounds that are given are passed so pymc3's defaults are used for the others
+    bounds = dict((k, v) for k, v in (('lower', lower), ('upper', upper)) if v is not None)
+
+    return Bound(Normal, **bounds)
+
+
 def generate_pymc_distribution(p, n_subjects=None, hierarchical=False, mle=False):
 
     """
@@ -61,11 +84,11 @@ def generate_pymc_distribution(p, n_subjects=None, hierarchical=False, mle=False
             raise ValueError("Hierarchical parameters only possible with > 1 subject")
 
         if p.distribution == 'normal' and p.lower_bound is not None and p.upper_bound is not None:
-            BoundedNormal = Bound(Normal, lower=p.lower_bound, upper=p.upper_bound)
+            BoundedNormal = _bounded_normal(p.lower_bound, p.upper_bound)
             if hierarchical:
                 p.pymc_distribution = BoundedNormal(p.name,
-                                                    mu=BoundedNormal(p.name + '_group_mu', mu=p.mean, sd=p.variance),
-                                                    sd=Uniform(p.name + '_group_sd', lower=0, upper=100),  # TODO need to allow adjustment of these values somehow
+                                                    mu=Normal(p.name + '_group_mu', mu=p.mean, sd=p.variance),
+                                                    sd=HalfNormal(p.name + '_group_sd', sd=10),  # TODO need to allow adjustment of these values somehow
                                                     shape=n_subjects, **kwargs)
             elif n_subjects > 1:
                 p.pymc_distribution = BoundedNormal(p.name, mu=p.mean, sd=p.variance, shape=n_subjects, **kwargs)
@@ -74,11 +97,11 @@ def generate_pymc_distribution(p, n_subjects=None, hierarchical=False, mle=False
             p.backward, p.forward = get_transforms(p)
 
         elif p.distribution == 'normal' and p.lower_bound is not None:
-            BoundedNormal = Bound(Normal, lower=p.lower_bound)
+            BoundedNormal = _bounded_normal(p.lower_bound)
             if hierarchical:
                 p.pymc_distribution = BoundedNormal(p.name,
-                                                    mu=BoundedNormal(p.name  + '_group_mu', mu=p.mean, sd=p.variance),
-                                                    sd=Uniform(p.name  + '_group_sd', lower=0, upper=100),
+                                                    mu=Normal(p.name  + '_group_mu', mu=p.mean, sd=p.variance),
+                                                    sd=HalfNormal(p.name + '_group_sd', sd=10),
                                                     shape=n_subjects, **kwargs)
             elif n_subjects > 1:
                 p.pymc_distribution = BoundedNormal(p.name, mu=p.mean, sd=p.variance, shape=n_subjects, **kwargs)
@@ -90,7 +113,7 @@ def generate_pymc_distribution(p, n_subjects=None, hierarchical=False, mle=False
             if hierarchical:
                 p.pymc_distribution = Normal(p.name,
                                              mu=Normal(p.name  + '_group_mu', mu=p.mean, sd=p.variance),
-                                             sd=Uniform(p.name + '_group_sd', lower=0, upper=100),
+                                             sd=HalfNormal(p.name + '_group_sd', sd=10),
                                              shape=n_subjects, transform=p.transform_method, **kwargs)
             elif n_subjects > 1:
                 p.pymc_distribution = Normal(p.name, mu=p.mean, sd=p.variance, shape=n_subjects,
@@ -135,18 +158,20 @@ def generate_choices2(pa):
 
 
 def backward(a, b, x):
-    a, b = a, b
-    r = (b - a) * np.exp(x) / (1 + np.exp(x)) + a
+    # expit is the logistic exp(x) / (1 + exp(x)) in a single pass, and doesn't overflow for large x
+    r = expit(x)
+    r *= b - a
+    r += a
     return r
 
 
 def bic(variables, n_subjects, outcomes, likelihood, individual=False):
 
     if not individual:
-        BIC = (len(variables) * n_subjects) * np.log(np.prod(outcomes.shape.eval())) - 2. * likelihood
+        BIC = (len(variables) * n_subjects) * math.log(int(np.prod(outcomes.shape.eval()))) - 2. * likelihood
 
     else:
-        BIC = len(variables) * np.log(outcomes.shape[0]) - 2. * likelihood
+        BIC = len(variables) * math.log(outcomes.shape[0]) - 2. * likelihood
 
     return BIC
 
@@ -154,9 +179,10 @@ def bic(variables, n_subjects, outcomes, likelihood, individual=False):
 def bic_regression(variables, n_subjects, outcomes, likelihood, individual=False):
 
     if not individual:
-        n = np.prod(outcomes.shape.eval())
-        BIC = n + n * np.log(2 * np.pi) + n * \
-              np.log((-likelihood.astype(np.float)) / n) + np.log(n) * (len(variables) * n_subjects)
+        # scalar case, terms that only depend on n use math.log rather than allocating numpy scalars
+        n = int(np.prod(outcomes.shape.eval()))
+        BIC = n + n * math.log(2 * math.pi) + n * \
+              np.log(-float(likelihood) / n) + math.log(n) * (len(variables) * n_subjects)
 
     else:
         n = outcomes.shape[0]
@@ -180,12 +206,9 @@ def model_fit(logp, fit_values, variables, outcome, n_subjects):
     """
     print("calculating fit stats")
 
-    variable_names = [i.name for i in variables]
-
-    for k in fit_values.keys():
-        if k not in variable_names:
-            fit_values.pop(k)
-
+    # only the model's free variables are passed to logp - selected into a new dictionary so the caller's fit values
+    # aren't modified
+    fit_values = dict((i.name, fit_values[i.name]) for i in variables if i.name in fit_values)
     likelihood = logp(fit_values)
 
     BIC = bic_regression(variables, n_subjects, outcome, likelihood)
@@ -196,31 +219,76 @@ def model_fit(logp, fit_values, variables, outcome, n_subjects):
     return likelihood, BIC, AIC
 
 
+def trace_means(trace):
+
+    """
+    Posterior means of every variable in a trace, in the same format as the mean column of a PyMC3 summary - scalar
+    variables are keyed by their name, and each element of an array variable by name__index (e.g. alpha__0)
+    """
+
+    means = OrderedDict()
+
+    for v in trace.varnames:
+        mean = np.asarray(trace[v].mean(axis=0))
+        if not mean.shape:
+            means[v] = float(mean)
+        else:
+            for idx in np.ndindex(*mean.shape):
+                means['{0}__{1}'.format(v, '_'.join(str(i) for i in idx))] = float(mean[idx])
+
+    return means
+
+
 def parameter_table(df_summary, subjects, logp_rvs):
 
     """
     Attempts to turn the pymc3 output into a nice table of parameter values for each subject
     """
+    statistics = ['mean', 'sd', 'mc_error', 'hpd_2.5', 'hpd_97.5']
+
     df_summary = df_summary[df_summary.index != 'eeee']
-    df_summary = df_summary[['mean', 'sd', 'mc_error', 'hpd_2.5', 'hpd_97.5']]
+    df_summary = df_summary[statistics]
     df_summary = df_summary.reset_index()
-    df_summary = df_summary[~df_summary['index'].str.contains('group')]
+    df_summary = df_summary[~df_summary['index'].str.contains('group', regex=False)]
     df_summary = df_summary[~df_summary['index'].isin(logp_rvs)]
 
     n_subjects = len(subjects)
     n_parameters = int(len(df_summary) / n_subjects)
-    subject_column = pd.Series(np.tile(subjects, n_parameters))
-    df_summary['Subject'] = subject_column.values
-    if len(subjects) > 1:
-        df_summary['index'] = pd.Series([re.search('.+(?=__)', i).group() for i in df_summary['index']]).values
 
-    df_summary = df_summary.pivot(index='Subject', columns='index')
-    df_summary.columns = df_summary.columns.map('_'.join)
-    df_summary = df_summary.reset_index()
+    # rows are in blocks of one parameter, each containing every subject in order, so the summary is a regular
+    # (parameter, subject, statistic) grid - reshape it into one row per subject rather than pivoting
+    parameter_names = df_summary['index'].values[::n_subjects]
+    if n_subjects > 1:
+        parameter_names = np.array([_PARAMETER_NAME_RE.match(i).group(1) for i in parameter_names])
+
+    # parameters are sorted by name, subjects are already sorted when loaded
+    order = np.argsort(parameter_names)
+    parameter_names = parameter_names[order]
+
+    values = df_summary[statistics].values.reshape(n_parameters, n_subjects, len(statistics))[order]
+    values = values.transpose(1, 2, 0).reshape(n_subjects, len(statistics) * n_parameters)
+
+    df_summary = pd.DataFrame(values, columns=['{0}_{1}'.format(s, p) for s in statistics for p in parameter_names])
+    df_summary.insert(0, 'Subject', subjects)
 
     return df_summary
 
 
+def _read_csv(data_file):
+
+    """
+    Reads a csv file into a dataframe, using pandas' multithreaded pyarrow parser if it is available. Older pandas
+    versions raise a ValueError for the unknown engine, and newer ones an ImportError if pyarrow isn't installed - in
+    both cases the default parser is used instead
+
+    """
+
+    try:
+        return pd.read_csv(data_file, engine='pyarrow')
+    except (ImportError, ValueError):
+        return pd.read_csv(data_file)
+
+
 def load_data(data_file, exclude_subjects=None, exclude_runs=None, additional_inputs=None):
 
     # TODO rewrite all of this because it's a mess
@@ -235,7 +303,7 @@ def load_data(data_file, exclude_subjects=None, exclude_runs=None, additional_in
 
     if not isinstance(data_file, pd.DataFrame):
         try:
-            data = pd.read_csv(data_file)
+            data = _read_csv(data_file)
         except ValueError:
             raise ValueError("Responses are not in the correct format, ensure they are provided as a .csv or .txt file")
     else:
@@ -285,22 +353,14 @@ def load_data(data_file, exclude_subjects=None, exclude_runs=None, additional_in
     else:
         print("Loading single subject data")
 
-    try:
-        trial_index = np.tile(range(0, n_trials), n_runs * n_subjects)
-    except:
+    if len(data) % (n_subjects * n_runs):
         raise ValueError("Each run must have the same number of trials")
 
-    data['Trial_index'] = trial_index
-
-    if 'Run' in data.columns:
-        data['Subject'] = data['Subject'].astype(str) + data['Run'].astype(str)
-
-    responses = np.split(data.Response.values, n_subjects * n_runs)
-    responses = np.array(responses)
+    # rows are ordered by subject and run, so reshaping gives one row per run without copying the data
+    responses = data.Response.values.reshape(n_subjects * n_runs, n_trials)
 
     if 'Outcome' in data.columns:
-        outcomes = np.split(data.Outcome.values, n_subjects * n_runs)
-        outcomes = np.array(outcomes).T
+        outcomes = data.Outcome.values.reshape(n_subjects * n_runs, n_trials).T
     else:
         outcomes = None
 
@@ -309,16 +369,12 @@ def load_data(data_file, exclude_subjects=None, exclude_runs=None, additional_in
     for i in additional_inputs:
         if i not in data.columns:
             raise AttributeError("Response file has no column named {0}".format(i))
-        input_data = np.split(data[i].values, n_subjects * n_runs)
-        input_data = np.array(input_data).T
-        additional_input_data.append(input_data)
+        additional_input_data.append(data[i].values.reshape(n_subjects * n_runs, n_trials).T)
 
-    if not len(additional_inputs) and any('sim_model_input' in i for i in data.columns):
+    if not len(additional_inputs):
         for i in data.columns:
             if 'sim_model_input' in i:
-                input_data = np.split(data[i].values, n_subjects * n_runs)
-                input_data = np.array(input_data).T
-                additional_input_data.append(input_data)
+                additional_input_data.append(data[i].values.reshape(n_subjects * n_runs, n_trials).T)
 
     print("Loaded data, {0} subjects with {1} trials * {2} runs".format(n_subjects, n_trials, n_runs))
 
@@ -330,7 +386,7 @@ def load_outcomes(data):
     if type(data) == str:
         try:
             outcomes = np.loadtxt(data)
-        except:
+        except (IOError, ValueError):
             raise ValueError("Outcomes not provided in the right format")
 
     elif type(data) == np.ndarray or type(data) == list:
@@ -339,11 +395,23 @@ def load_outcomes(data):
     else:
         raise ValueError("Outcome data must be either filename, numpy array, or list")
 
-    return outcomes
+    # converted once here to the layout and dtype used by the model, so later conversions don't need to copy
+    return np.ascontiguousarray(outcomes, dtype=theano.config.floatX)
 
 
 def n_returns(f):
 
+    n, returns = _n_returns(f)
+
+    return n, list(returns)
+
+
+@lru_cache(maxsize=None)
+def _n_returns(f):
+
+    # reading the source is slow, so results are cached for each function - returns are given as a tuple so the cached
+    # value can't be modified
+
     try:
         return_code = inspect.getsourcelines(f)[0][-1].replace('\n', '')
     except:
@@ -360,11 +428,12 @@ def n_returns(f):
         warnings.warn("Could not retrieve function return names")
         returns = None
 
-    returns = [i for i in returns if len(i)]
+    returns = tuple(i for i in returns if len(i))
 
     return n, returns
 
 
+@lru_cache(maxsize=None)
 def n_obs_dynamic(f, n_obs_params):
 
     return len(inspect.getargspec(f)[0]) - n_obs_params
@@ -387,12 +456,12 @@ def function_wrapper(f, n_returns, n_reused=1, n_model_inputs=0):
 
     """
 
-    def wrapped(*args):
-        outs = [args[0]] * n_returns
-        outs[0:n_reused] = args[n_model_inputs + 2:n_reused + n_model_inputs + 2]
-        outs = tuple(outs)
+    start = n_model_inputs + 2
+    n_pad = n_returns - n_reused
 
-        return outs
+    def wrapped(*args):
+        # built by tuple slicing and repetition, avoiding creating and filling a list on every call
+        return args[start:start + n_reused] + (args[0],) * n_pad
 
     return wrapped
 
@@ -412,6 +481,35 @@ def flatten_simulated(simulated):
     return simulated.flatten(order='F')
 
 
+def cartesian_product(arrays):
+
+    """
+    Creates every combination of the values in the provided arrays, in the same order as itertools.product
+
+    Args:
+        arrays: List of 1D arrays of values
+
+    Returns:
+        An array of shape (number of combinations, number of arrays)
+
+    """
+
+    arrays = [np.asarray(i) for i in arrays]
+    sizes = [len(i) for i in arrays]
+    n_rows = int(np.prod(sizes))
+
+    out = np.empty((n_rows, len(arrays)), dtype=np.result_type(*arrays))
+
+    # each column is its values repeated for every combination of the columns to its right, then tiled for every
+    # combination of the columns to its left
+    inner = n_rows
+    for n, i in enumerate(arrays):
+        inner //= sizes[n]
+        out[:, n] = np.tile(np.repeat(i, inner), n_rows // (inner * sizes[n]))
+
+    return out
+
+
 def simulated_dataframe(simulation_results, outcomes, responses, model_inputs, n_runs, n_subjects, subjects,
                         learning_parameters, observation_parameters, fit_complete):
 
@@ -428,15 +526,13 @@ def simulated_dataframe(simulation_results, outcomes, responses, model_inputs, n
     # Generate "subject" ids and run numbers for simulated data output
     if not fit_complete:
 
-        subject_ids = np.arange(0, n_subjects)
-        subject_ids = np.repeat(subject_ids, n_runs)
-        subject_ids = ['Subject_' + str(i).zfill(len(str(subject_ids.max()))) for i in subject_ids]
-        subject_ids = np.repeat(subject_ids, n_trials)
+        subject_ids = np.arange(0, n_subjects).astype(str)
+        subject_ids = np.char.add('Subject_', np.char.zfill(subject_ids, len(str(n_subjects - 1))))
+        subject_ids = np.repeat(subject_ids, n_runs * n_trials)
 
-        run_ids = np.arange(0, n_runs)
-        run_ids = np.tile(run_ids, n_subjects)
-        run_ids = ['Run_' + str(i).zfill(len(str(run_ids.max()))) for i in run_ids]
-        run_ids = np.repeat(run_ids, n_trials)
+        run_ids = np.arange(0, n_runs).astype(str)
+        run_ids = np.char.add('Run_', np.char.zfill(run_ids, len(str(n_runs - 1))))
+        run_ids = np.tile(np.repeat(run_ids, n_trials), n_subjects)
 
     # If using values from model fit, use subject IDs
     else:
@@ -456,12 +552,16 @@ def simulated_dataframe(simulation_results, outcomes, responses, model_inputs, n
     for n, i in enumerate(model_inputs):
         simulated_df['sim_model_input_{0}'.format(n)] = i
 
-    # add parameter columns
-    for p, v in learning_parameters.items():
-        simulated_df[p + '_sim'] =  np.repeat(v, n_trials)
-    for p, v in observation_parameters.items():
-        simulated_df[p + '_sim'] = np.repeat(v, n_trials)
+    # add parameter columns - repeated for each trial as a single block and added in one concatenation rather than
+    # inserting each column separately
+    parameters = OrderedDict(learning_parameters)
+    parameters.update(observation_parameters)
 
+    if len(parameters):
+        parameter_values = np.repeat(np.column_stack(list(parameters.values())), n_trials, axis=0)
+        parameter_df = pd.DataFrame(parameter_values, columns=[p + '_sim' for p in parameters],
+                                    index=simulated_df.index)
+        simulated_df = pd.concat([simulated_df, parameter_df], axis=1)
 
     return simulated_df
 
@@ -477,21 +577,13 @@ def stdoutIO(stdout=None):
     sys.stdout = old
 #
 
-def model_check(model_function, parameters):
+@lru_cache(maxsize=None)
+def _function_body_lines(code):
 
-    if not isinstance(parameters, dict):
-        raise ValueError("Please supply parameters as a dictionary of format {'param_name':value}")
+    # reading the source is slow, so the lines are cached for each function's code object - returned as a tuple so the
+    # cached value can't be modified
 
-    args = inspect.getargspec(model_function)[0]
-    _, returns = n_returns(model_function)
-
-    if len(parameters.keys()) != len(args):
-        raise ValueError("Number of supplied parameters ({0}) does not match number of required parameters ({1}).\n\n"
-                         "Supplied parameters = {2}\n\n"
-                         "Required parameters = {3}".format(len(parameters.keys()), len(args),
-                                                            ', '.join(parameters.keys()), ', '.join(args)))
-
-    function_code = inspect.getsource(model_function)
+    function_code = inspect.getsource(code)
     function_code = re.sub('"""[\s\S\d\D\w\W]*?"""', '', function_code)
     function_code = function_code.split('\n')
 
@@ -505,6 +597,45 @@ def model_check(model_function, parameters):
                 if i[0] != '#':
                     lines.append(i)
 
+    return tuple(lines)
+
+
+def _assigned_names(node):
+
+    # names of the variables assigned by a statement, including each name in tuple assignments
+
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, ast.AugAssign):
+        targets = [node.target]
+    else:
+        return []
+
+    names = []
+
+    for t in targets:
+        elements = t.elts if isinstance(t, ast.Tuple) else [t]
+        names += [i.id for i in elements if isinstance(i, ast.Name)]
+
+    return names
+
+
+def model_check(model_function, parameters):
+
+    if not isinstance(parameters, dict):
+        raise ValueError("Please supply parameters as a dictionary of format {'param_name':value}")
+
+    args = inspect.getargspec(model_function)[0]
+    _, returns = n_returns(model_function)
+
+    if len(parameters.keys()) != len(args):
+        raise ValueError("Number of supplied parameters ({0}) does not match number of required parameters ({1}).\n\n"
+                         "Supplied parameters = {2}\n\n"
+                         "Required parameters = {3}".format(len(parameters.keys()), len(args),
+                                                            ', '.join(parameters.keys()), ', '.join(args)))
+
+    lines = list(_function_body_lines(model_function.__code__))
+
     for arg in args:
         try:
             print(arg, parameters[arg])
@@ -517,32 +648,33 @@ def model_check(model_function, parameters):
     lines.insert(0, 'import numpy as np')
     lines.insert(0, 'import theano.tensor as T')
 
-    for line in lines:
+    # parse the code once, each statement is then compiled from the parsed tree rather than from its source text
+    tree = ast.parse('\n'.join(lines))
+    namespace = {'os': '', 'shutil': '', 'sys': ''}  # evaluate code, making sure user can't do anything stupid
+
+    for node in tree.body:
         print("Running code:\n" \
-              "{0}".format(line))
-        vars = re.search('.*?(?=[\+\-\*\/\=])', line)
+              "{0}".format(lines[node.lineno - 1]))
         try:
-            exec(line, {'os': '', 'shutil': '', 'sys': ''}, globals())  # evaluate code, making sure user can't do anything stupid
+            exec(compile(ast.Interactive(body=[node]), '<model_check>', 'single'), namespace)
         except NameError:
             raise ValueError("This function doesn't cope well with functions/builtins - try providing them as strings,\n"
                              "e.g. 'np.inf' instead of np.inf")
-        if vars:
-            with stdoutIO() as s:
-                exec("print({0})".format(vars.group()))
-            out = s.getvalue().replace('\n', '')
+        for name in _assigned_names(node):
+            val = eval(name, namespace)
+            out = str(val).replace('\n', '')
             if not re.match('.+[}a-zA-Z]\.0', out):  # output is a tensor, need to eval
                 print("{0}\n".format(out))
             else:
-                exec('print({0}.eval())\nprint(" ")'.format(vars.group()))
+                print(val.eval())
+                print(" ")
 
     print("RETURNS")
 
     for i in returns:
         print(i)
-        try:
-            exec('print({0}).eval()'.format(i))
-        except:
-            exec ('print({0})'.format(i))
+        val = eval(i, namespace)
+        print(val.eval() if hasattr(val, 'eval') else val)
 
 
 def r2_individual(true, predicted):
@@ -653,10 +785,10 @@ def load_data_for_simulation(outcomes, model_inputs=()):
             raise ValueError("Additional inputs can only be specified if outcomes are specified as a dataframe")
 
         # Check for problems with outcomes
-        if any([i == 0 for i in outcomes.shape]):
+        if any(i == 0 for i in outcomes.shape):
             raise AttributeError("One outcome array dimension is zero")
 
-        if all([i == 1 for i in outcomes.shape]):
+        if all(i == 1 for i in outcomes.shape):
             raise AttributeError("Please provide more than one outcome, current outcomes shape = {0}".format(outcomes.shape))
 
         if outcomes.ndim > 2:
@@ -683,7 +815,7 @@ def load_data_for_simulation(outcomes, model_inputs=()):
 
         # If a string is provided, it should be the path to a file
         if isinstance(outcomes, str):
-            outcome_df = pd.read_csv(outcomes)
+            outcome_df = _read_csv(outcomes)
         else:
             outcome_df = outcomes
 
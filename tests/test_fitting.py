@@ -0,0 +1,73 @@
+from DMpy.model import Parameter, _PyMCModel, _CLOSED_FORM_MAX_TRIALS
+from DMpy.learning import rescorla_wagner
+from DMpy.utils import trace_means
+import numpy as np
+import theano
+import theano.tensor as T
+import pytest
+
+
+def rescorla_wagner_scan(outcomes, v0, alpha):
+
+    """ Values on each trial before seeing that trial's outcome, from a scan over rescorla_wagner """
+
+    o = T.matrix('o', dtype=theano.config.floatX)
+    v = T.vector('v', dtype=theano.config.floatX)
+    a = T.vector('a', dtype=theano.config.floatX)
+
+    (value, _), _ = theano.scan(fn=rescorla_wagner, sequences=[o, o], outputs_info=[v, None], non_sequences=[a])
+
+    value = theano.function([o, v, a], value)(outcomes, v0, alpha)
+
+    return np.vstack([v0, value[:-1]])
+
+
+@pytest.mark.parametrize('n_trials', [10, _CLOSED_FORM_MAX_TRIALS, _CLOSED_FORM_MAX_TRIALS + 10])
+def test_rescorla_wagner_value_matches_scan(n_trials):
+
+    """ get_value gives the same trajectories as scan, on both sides of the closed form trial limit """
+
+    n_subjects = 3
+    v0 = np.array([0.2, 0.5, 0.8], dtype=theano.config.floatX)
+    alpha = np.array([0.1, 0.3, 0.9], dtype=theano.config.floatX)
+
+    outcomes = np.random.RandomState(0).binomial(1, 0.7, (n_trials, n_subjects)).astype(theano.config.floatX)
+
+    value = Parameter('value', 'fixed', mean=v0, dynamic=True)
+    learning_rate = Parameter('alpha', 'fixed', mean=alpha)
+
+    model = _PyMCModel.dist(learning_model=rescorla_wagner, learning_parameters=[value, learning_rate],
+                            observation_model=None, observation_parameters=[[None], [0]], responses=None,
+                            hierarchical=False, n_subjects=n_subjects, time=None, n_runs=np.ones(n_subjects, dtype=int),
+                            outcomes=None, model_inputs=[], logp_function='beta')
+
+    estimated = model.get_value(theano.shared(outcomes))[0].eval()
+
+    assert estimated.shape == (n_trials, n_subjects)
+    assert np.allclose(estimated, rescorla_wagner_scan(outcomes, v0, alpha), atol=1e-5)
+
+
+class _Trace(object):
+
+    """ Minimal stand-in for a PyMC3 trace, holding samples for each variable """
+
+    def __init__(self, samples):
+        self._samples = samples
+        self.varnames = list(samples)
+
+    def __getitem__(self, varname):
+        return self._samples[varname]
+
+
+def test_trace_means_match_summary_format():
+
+    """ Fit values have one scalar per element, keyed as in the mean column of a PyMC3 summary """
+
+    samples = dict(alpha=np.random.rand(50, 3), alpha_interval__=np.random.randn(50, 3), beta=np.random.rand(50))
+    means = trace_means(_Trace(samples))
+
+    assert sorted(means) == sorted(['alpha__0', 'alpha__1', 'alpha__2', 'alpha_interval____0', 'alpha_interval____1',
+                                    'alpha_interval____2', 'beta'])
+    assert all(isinstance(v, float) for v in means.values())
+    assert np.allclose([means['alpha__{0}'.format(i)] for i in range(3)], samples['alpha'].mean(axis=0))
+    assert np.isclose(means['beta'], samples['beta'].mean())
@@ -1,11 +1,14 @@
 import unittest
-from DMpy.model import DMModel, Parameter
+from DMpy.model import DMModel, Parameter, _add_noise
 from DMpy.learning import rescorla_wagner
 from DMpy.observation import softmax
 import numpy as np
-from DMpy.utils import _check_column, load_data_for_simulation, parameter_check, simulated_dataframe
+from DMpy.utils import _check_column, load_data_for_simulation, parameter_check, simulated_dataframe, cartesian_product
 import pandas as pd
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import pytest
+from itertools import product
 
 
 @pytest.fixture()
@@ -43,7 +46,7 @@ def example_dataframe_loaded():
 def simulated_model(obs_model, outcomes):
     obs_model.simulate(outcomes=np.vstack([outcomes, outcomes]).T, learning_parameters=dict(value=0.5, alpha=[0.3, 0.4]),
                        observation_parameters=dict(beta=[3, 4]), n_subjects=2, combinations=True)
-    print obs_model.simulation_results.Outcome
+    print(obs_model.simulation_results.Outcome)
     return obs_model
 
 @pytest.fixture()
@@ -64,6 +67,30 @@ def test_check_missing_parameters(obs_model, outcomes):
         obs_model.simulate(outcomes=np.vstack([outcomes, outcomes]), learning_parameters=dict(alpha=[0.3, 0.4]),
                            observation_parameters=dict(beta=[3, 4]), n_subjects=2)
 
+def test_simulate_plot_without_fit(obs_model, outcomes):
+
+    """Plotting a simulation from user-supplied parameter values, where runs are labelled with strings"""
+
+    plt.close('all')
+
+    # each outcome column is a run, so this simulates two runs
+    obs_model.simulate(outcomes=np.vstack([outcomes, outcomes]).T, learning_parameters=dict(value=0.5, alpha=[0.3, 0.4]),
+                       observation_parameters=dict(beta=[3, 4]), n_subjects=2, combinations=True, plot=True)
+
+    n_subjects = obs_model.simulation_results.Subject.unique().shape[0]
+
+    # the first figure shows the response variable, with one panel per run
+    response_axes = plt.figure(plt.get_fignums()[0]).axes
+    assert len(response_axes) == 2
+
+    for ax in response_axes:
+        lines = [i for i in ax.collections if isinstance(i, LineCollection)]
+        assert len(lines) == 1
+        assert len(lines[0].get_segments()) == n_subjects
+        assert all(len(i) == len(outcomes) for i in lines[0].get_segments())
+
+    plt.close('all')
+
 class TestParameterCombinations(object):
 
     """ Test method that creates combinations of parameter values"""
@@ -104,6 +131,12 @@ class TestParameterCombinations(object):
 
         assert combinations[0].shape == (4, 2)
 
+    def test_cartesian_product_matches_itertools(self):
+
+        values = [[0.1, 0.2], [3, 4, 5]]
+
+        assert np.all(cartesian_product(values) == np.array(list(product(*values))))
+
     def test_value_label_order(self, obs_model, outcomes):
         # TODO test again when things aren't broken
         obs_model.simulate(outcomes=outcomes, learning_parameters=dict(value=0.5, alpha=[0.3, 0.4]),
@@ -147,7 +180,7 @@ class TestSimulatedDataFrame(object):
         for i in df.columns:
             if '_sim' in i:
                 tests.append(len(df[i][df.Subject == df.Subject.unique()[0]].unique()) == 1)
-        print tests
+        print(tests)
         assert all(tests)
 
     def test_all_parameters_in_dataframe(self, simulated_model):
@@ -343,11 +376,73 @@ def test_parameter_check_fit_parameters():
         parameter_check(['a'], sim=False)
 
 
+class TestAddNoise(object):
+
+    """ Test function that adds gaussian noise to simulated responses """
+
+    def test_noise_within_bounds(self):
+
+        noisy = _add_noise(np.linspace(0, 1, 1000), 0, 1, lower_bound=0, upper_bound=1)
+
+        assert noisy.min() >= 0 and noisy.max() <= 1
+
+    def test_noise_shape(self):
+
+        assert _add_noise(np.ones((10, 2)) * 0.5, 0, 0.1).shape == (10, 2)
+
+    def test_no_noise(self):
+
+        timeseries = np.linspace(0, 1, 10)
+
+        assert np.allclose(_add_noise(timeseries, 0, 0), timeseries)
+
+
+class TestFastSimulation(object):
+
+    """ Test that the NumPy simulation of rescorla_wagner matches the compiled Theano simulation """
+
+    @staticmethod
+    def _simulate_both(model, outcomes, **kwargs):
+
+        model.simulate(outcomes=outcomes, fast=True, **kwargs)
+        fast = model.simulation_results.copy()
+        model.simulate(outcomes=outcomes, fast=False, **kwargs)
+        compiled = model.simulation_results
+
+        return fast, compiled
+
+    # a single simulated subject, and several subjects for each of several parameter combinations
+    @pytest.mark.parametrize('alpha, beta, n_subjects', [([0.3], [3], 1), ([0.3, 0.4], [3, 4], 3)])
+    def test_fast_matches_compiled_observation_model(self, obs_model, outcomes, alpha, beta, n_subjects):
+
+        fast, compiled = self._simulate_both(obs_model, outcomes, learning_parameters=dict(value=0.5, alpha=alpha),
+                                             observation_parameters=dict(beta=beta), n_subjects=n_subjects,
+                                             combinations=True)
+
+        for column in ['value', 'pe', 'prob', 'Response']:
+            assert np.allclose(fast[column], compiled[column])
+
+    @pytest.mark.parametrize('alpha, n_subjects', [([0.3], 1), ([0.3, 0.4], 3)])
+    def test_fast_matches_compiled_no_observation_model(self, no_obs_model, outcomes, alpha, n_subjects):
 
+        fast, compiled = self._simulate_both(no_obs_model, outcomes, learning_parameters=dict(value=0.5, alpha=alpha),
+                                             n_subjects=n_subjects, combinations=True, response_variable='value')
 
+        for column in ['value', 'pe', 'Response']:
+            assert np.allclose(fast[column], compiled[column])
 
 
+def test_parallel_simulation_matches_single_process(obs_model, outcomes):
 
+    """ Splitting subjects across processes gives the same results as simulating them in one process """
 
+    kwargs = dict(learning_parameters=dict(value=0.5, alpha=[0.3, 0.4]), observation_parameters=dict(beta=[3, 4]),
+                  n_subjects=2, combinations=True, fast=False)
 
+    obs_model.simulate(outcomes=outcomes, n_jobs=1, **kwargs)
+    single = obs_model.simulation_results.copy()
+    obs_model.simulate(outcomes=outcomes, n_jobs=2, **kwargs)
+    parallel = obs_model.simulation_results
 
+    for column in ['value', 'pe', 'prob', 'Response']:
+        assert np.allclose(single[column], parallel[column])